@@ -1,6 +1,7 @@
 import asyncio
 import os
 import logging
+import threading
 from typing import List
 from fastmcp import FastMCP
 from typing import Optional
@@ -26,19 +27,27 @@ load_dotenv()
 spotify_handler = None
 playlist_generator = None
 port = int(os.getenv("PORT", 10000))
+# Building the handler can restore a saved session over the network, so async
+# callers run initialize_services in a worker thread; only one may build the services
+_init_lock = threading.Lock()
 
 def initialize_services():
-    """Initialize Spotify handler and playlist generator."""
+    """Initialize Spotify handler and playlist generator, once per process."""
     global spotify_handler, playlist_generator
     
-    try:
-        spotify_handler = SpotifyHandler()
-        playlist_generator = PlaylistGenerator(spotify_handler)
-        logger.info("Services initialized successfully")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to initialize services: {e}")
-        return False
+    with _init_lock:
+        if spotify_handler and playlist_generator:
+            return True
+        
+        try:
+            if not spotify_handler:
+                spotify_handler = SpotifyHandler()
+            playlist_generator = PlaylistGenerator(spotify_handler)
+            logger.info("Services initialized successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to initialize services: {e}")
+            return False
 
 async def health_check() -> List[TextContent]:
     """Health check endpoint."""
@@ -55,7 +64,7 @@ async def authenticate_spotify() -> List[TextContent]:
     """Get Spotify authentication URL."""
     try:
         if not spotify_handler:
-            if not initialize_services():
+            if not await asyncio.to_thread(initialize_services):
                 return [TextContent(
                     type="text",
                     text="Failed to initialize Spotify. Check environment variables."
@@ -97,7 +106,7 @@ async def complete_authentication(auth_code: str) -> List[TextContent]:
                 text="Spotify handler not initialized. Please try again."
             )]
         
-        if spotify_handler.authenticate_with_code(auth_code):
+        if await asyncio.to_thread(spotify_handler.authenticate_with_code, auth_code):
             return [TextContent(
                 type="text",
                 text="✅ **Authentication successful!** You can now generate playlists."
@@ -117,7 +126,7 @@ async def complete_authentication(auth_code: str) -> List[TextContent]:
 async def fetch_user_data() -> List[TextContent]:
     """Fetch and store user's Spotify data."""
     try:
-        if not spotify_handler or not spotify_handler.is_authenticated():
+        if not spotify_handler or not await asyncio.to_thread(spotify_handler.is_authenticated):
             return [TextContent(
                 type="text",
                 text="Please authenticate with Spotify first using the 'authenticate' tool."
@@ -152,13 +161,13 @@ async def generate_spotify_playlist(
     """Generate a Spotify playlist based on prompt."""
     try:
         if not spotify_handler:
-            if not initialize_services():
+            if not await asyncio.to_thread(initialize_services):
                 return [TextContent(
                     type="text",
                     text="Failed to initialize services. Check environment variables."
                 )]
         
-        if spotify_handler is None or not spotify_handler.is_authenticated():
+        if spotify_handler is None or not await asyncio.to_thread(spotify_handler.is_authenticated):
             return [TextContent(
                 type="text",
                 text="❌ **Not authenticated with Spotify!**\n\nPlease use the 'authenticate' tool first to connect your Spotify account."
@@ -182,16 +191,20 @@ async def generate_spotify_playlist(
                 text="Playlist generator not available."
             )]
 
-        # Fetch user data if not already done
+        # Fetch fresh user data and hand it to the generator so it isn't re-read from disk.
+        # Only the first page is needed here, the generator reads just the top tracks;
+        # the 'fetch_data' tool pages through the whole library.
+        user_data = None
         try:
-            await spotify_handler.fetch_all_user_data()
+            user_data = await spotify_handler.fetch_all_user_data(max_pages=1)
         except Exception as e:
             logger.warning(f"Could not fetch user data: {e}")
 
         playlist_url = await playlist_generator.create_playlist(
             prompt=prompt,
             duration_minutes=duration_minutes,
-            playlist_name=playlist_name
+            playlist_name=playlist_name,
+            user_data=user_data
         )
 
         return [TextContent(
@@ -249,7 +262,7 @@ def setup_mcp_server() -> FastMCP:
     ) -> List[TextContent]:
         """Generate a Spotify playlist based on a prompt. Requires authentication first."""
         
-        if not spotify_handler or not spotify_handler.is_authenticated():
+        if not spotify_handler or not await asyncio.to_thread(spotify_handler.is_authenticated):
             return [TextContent(
                 type="text",
                 text=(
@@ -268,7 +281,7 @@ async def main():
     try:
         logger.info(f"Starting Spotify MCP Server on port {port}")
         
-        if not initialize_services():
+        if not await asyncio.to_thread(initialize_services):
             logger.warning("Service initialization failed - check environment variables")
         
         server = setup_mcp_server()
@@ -1,9 +1,13 @@
 import os
+import re
 import json
+import asyncio
 import random
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from dotenv import load_dotenv
 from spotify_handler import SpotifyHandler
 
@@ -15,9 +19,45 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-import google.generativeai as genai
-from google.generativeai.generative_models import GenerativeModel
-from google.generativeai.client import configure
+MAX_SEARCH_QUERIES = 7
+POPULAR_QUERIES = ('popular music', 'trending songs')
+NO_RESULTS_QUERIES = ('popular songs', 'top hits')
+
+# Bollywood search queries, the first seven are the core fallback set
+BOLLYWOOD_QUERIES = (
+    "bollywood hits",
+    "arijit singh",
+    "shreya ghoshal",
+    "atif aslam",
+    "hindi songs",
+    "bollywood romantic",
+    "ar rahman",
+    "rahat fateh ali khan",
+    "armaan malik",
+    "bollywood dance",
+    "latest bollywood",
+    "90s bollywood",
+)
+BOLLYWOOD_CORE_QUERY_COUNT = 7
+
+FALLBACK_GENRES = ('pop', 'rock', 'hip hop', 'electronic', 'indie', 'jazz', 'country', 'r&b')
+# Single alternation so all genres are found in one scan of the prompt
+_GENRE_RE = re.compile('|'.join(
+    re.escape(genre) for genre in sorted(FALLBACK_GENRES, key=len, reverse=True)
+))
+
+# (trigger words, queries) in priority order, the first matching mood wins
+MOOD_QUERIES = (
+    (('happy', 'upbeat', 'energetic', 'party'), ('upbeat songs', 'dance music', 'party hits')),
+    (('sad', 'emotional', 'melancholy'), ('sad songs', 'ballads', 'emotional music')),
+    (('chill', 'relax', 'calm'), ('chill music', 'relaxing songs', 'ambient')),
+    (('workout', 'gym', 'exercise'), ('workout music', 'high energy', 'pump up')),
+)
+# One named group per mood so a single scan reports every mood present
+_MOOD_RE = re.compile('|'.join(
+    f"(?P<mood{i}>{'|'.join(re.escape(word) for word in words)})"
+    for i, (words, _) in enumerate(MOOD_QUERIES)
+))
 
 class PlaylistGenerator:
     """Playlist generator using Gemini AI for recommendations."""
@@ -28,35 +68,37 @@ class PlaylistGenerator:
         self.model = None
         
         # Configure Gemini if available
-        if genai:
-            gemini_api_key = os.getenv("GEMINI_API_KEY")
-            if gemini_api_key:
-                try:
-                    configure(api_key=gemini_api_key)
-                    self.model = GenerativeModel('gemini-2.0-flash')
-                    logger.info("Playlist generator initialized with Gemini")
-                except Exception as e:
-                    logger.warning(f"Failed to initialize Gemini: {e}")
-                    self.model = None
-            else:
-                logger.warning("GEMINI_API_KEY not set, using fallback mode")
+        gemini_api_key = os.getenv("GEMINI_API_KEY")
+        if gemini_api_key:
+            try:
+                # Imported lazily: the SDK is slow to load and only needed with a key
+                from google.generativeai.client import configure
+                from google.generativeai.generative_models import GenerativeModel
+                
+                configure(api_key=gemini_api_key)
+                self.model = GenerativeModel('gemini-2.0-flash')
+                logger.info("Playlist generator initialized with Gemini")
+            except Exception as e:
+                logger.warning(f"Failed to initialize Gemini: {e}")
+                self.model = None
         else:
-            logger.info("Using fallback mode without Gemini AI")
+            logger.warning("GEMINI_API_KEY not set, using fallback mode")
                     
     async def create_playlist(
         self, 
         prompt: str, 
         duration_minutes: int, 
-        playlist_name: str
+        playlist_name: str,
+        user_data: Optional[Dict[str, Any]] = None
     ) -> str:
-        """Create a playlist using AI recommendations."""
+        """Create a playlist using AI recommendations, optionally from freshly fetched user data."""
         
         logger.info(f"Creating playlist: '{playlist_name}' with prompt: '{prompt}'")
         
         # Step 1: Get user context if authenticated
         user_context = ""
-        if self.spotify.is_authenticated():
-            user_context = await self._get_user_context()
+        if await asyncio.to_thread(self.spotify.is_authenticated):
+            user_context = await self._get_user_context(user_data)
         
         # Step 2: Generate search queries (with or without AI)
         search_queries = await self._generate_search_queries(prompt, user_context)
@@ -64,8 +106,8 @@ class PlaylistGenerator:
         
         # Step 3: Search for tracks using generated queries
         all_tracks = []
-        for query in search_queries:
-            tracks = self.spotify.search_tracks(query, limit=15)
+        search_results = await self.spotify.search_tracks_many(search_queries, limit=15)
+        for query, tracks in zip(search_queries, search_results):
             if tracks:
                 all_tracks.extend(tracks)
                 logger.info(f"Found {len(tracks)} tracks for query: '{query}'")
@@ -73,13 +115,13 @@ class PlaylistGenerator:
         logger.info(f"Total tracks found from searches: {len(all_tracks)}")
         
         # Step 4: Get recommendations if we have user data and found tracks
-        if self.spotify.is_authenticated() and all_tracks:
+        if all_tracks and await asyncio.to_thread(self.spotify.is_authenticated):
             try:
                 # Use some found tracks as seeds for recommendations
                 seed_ids = [track["id"] for track in all_tracks[:5] if track.get("id") and len(track["id"]) == 22]
                 if seed_ids:
                     logger.info(f"Attempting recommendations with seeds: {seed_ids}")
-                    rec_tracks = self.spotify.get_recommendations(seed_ids, limit=20)
+                    rec_tracks = await asyncio.to_thread(self.spotify.get_recommendations, seed_ids, limit=20)
                     if rec_tracks:
                         all_tracks.extend(rec_tracks)
                         logger.info(f"Added {len(rec_tracks)} recommended tracks")
@@ -96,9 +138,8 @@ class PlaylistGenerator:
         
         if not unique_tracks:
             # If no tracks found, try some fallback searches
-            fallback_queries = self._get_bollywood_fallback_queries() if 'bollywood' in prompt.lower() else ['popular songs', 'top hits']
-            for query in fallback_queries:
-                tracks = self.spotify.search_tracks(query, limit=20)
+            fallback_queries = self._get_bollywood_fallback_queries() if 'bollywood' in prompt.lower() else NO_RESULTS_QUERIES
+            for tracks in await self.spotify.search_tracks_many(list(fallback_queries), limit=20):
                 unique_tracks.extend(tracks)
             
             unique_tracks = self._remove_duplicates(unique_tracks)
@@ -113,20 +154,21 @@ class PlaylistGenerator:
         
         logger.info(f"Selected {len(selected_tracks)} tracks for playlist")
         
-        # Step 7: Save track data
-        await self._save_playlist_data(selected_tracks, prompt, playlist_name)
-        
-        # Step 8: Create Spotify playlist
-        playlist_url = self.spotify.create_playlist(
-            name=playlist_name,
-            description=f"AI-generated playlist: {prompt}"
+        # Step 7 & 8: Save track data and create Spotify playlist concurrently
+        _, playlist_url = await asyncio.gather(
+            self._save_playlist_data(selected_tracks, prompt, playlist_name),
+            asyncio.to_thread(
+                self.spotify.create_playlist,
+                name=playlist_name,
+                description=f"AI-generated playlist: {prompt}"
+            )
         )
         
         # Step 9: Add tracks to playlist
         track_uris = [track["uri"] for track in selected_tracks if track.get("uri")]
         if track_uris:
             playlist_id = playlist_url.split("/")[-1]
-            added_count = self.spotify.add_tracks_to_playlist(playlist_id, track_uris)
+            added_count = await asyncio.to_thread(self.spotify.add_tracks_to_playlist, playlist_id, track_uris)
             logger.info(f"Added {added_count} tracks to playlist")
         
         logger.info(f"Playlist created successfully: {playlist_url}")
@@ -134,23 +176,17 @@ class PlaylistGenerator:
     
     def _get_bollywood_fallback_queries(self) -> List[str]:
         """Get Bollywood-specific fallback queries."""
-        return [
-            "bollywood hits",
-            "hindi songs",
-            "arijit singh",
-            "shreya ghoshal", 
-            "atif aslam",
-            "rahat fateh ali khan",
-            "armaan malik",
-            "bollywood romantic",
-            "bollywood dance",
-            "latest bollywood",
-            "90s bollywood",
-            "ar rahman"
-        ]
+        return list(BOLLYWOOD_QUERIES)
     
-    async def _get_user_context(self) -> str:
+    async def _get_user_context(self, user_data: Optional[Dict[str, Any]] = None) -> str:
         """Get user listening context for better recommendations."""
+        if user_data is not None:
+            return self._build_user_context(user_data)
+        # Reading the data file is blocking I/O, keep it off the event loop
+        return await asyncio.to_thread(self._get_user_context_sync)
+    
+    def _get_user_context_sync(self) -> str:
+        """Load user listening context from the latest user data file."""
         try:
             # Load recent user data if available
             import glob
@@ -160,18 +196,27 @@ class PlaylistGenerator:
             
             # Get the most recent file
             latest_file = max(data_files, key=os.path.getctime)
+            
             with open(latest_file, 'r', encoding='utf-8') as f:
                 user_data = json.load(f)
             
+            return self._build_user_context(user_data)
+            
+        except Exception as e:
+            logger.warning(f"Failed to get user context: {e}")
+            return ""
+    
+    def _build_user_context(self, user_data: Dict[str, Any]) -> str:
+        """Summarize the user's top artists from fetched user data."""
+        try:
             # Extract key preferences
             top_artists = []
             if user_data.get("top_tracks"):
-                top_artists = list(set([
+                top_artists = list(islice({
                     track["artist"] for track in user_data["top_tracks"][:10]
-                ]))[:5]
+                }, 5))
             
-            context = f"User's top artists: {', '.join(top_artists)}" if top_artists else ""
-            return context
+            return f"User's top artists: {', '.join(top_artists)}" if top_artists else ""
             
         except Exception as e:
             logger.warning(f"Failed to get user context: {e}")
@@ -207,7 +252,7 @@ class PlaylistGenerator:
             - For "sad songs": "melancholy ballads", "acoustic sad", "emotional indie", "heartbreak songs"
             """
             
-            response = self.model.generate_content(gemini_prompt)
+            response = await self.model.generate_content_async(gemini_prompt)
             queries = [
                 line.strip() 
                 for line in response.text.split('\n') 
@@ -220,7 +265,7 @@ class PlaylistGenerator:
                 return self._generate_fallback_queries(prompt)
             
             logger.info(f"Gemini generated search queries: {queries}")
-            return queries[:7]  # Limit to 7 queries
+            return queries[:MAX_SEARCH_QUERIES]
             
         except Exception as e:
             logger.error(f"Failed to generate search queries with Gemini: {e}")
@@ -228,43 +273,34 @@ class PlaylistGenerator:
     
     def _generate_fallback_queries(self, prompt: str) -> List[str]:
         """Generate search queries without AI."""
+        return list(self._fallback_queries_for(prompt))
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _fallback_queries_for(prompt: str) -> Tuple[str, ...]:
+        """Build fallback queries for a prompt, cached since it only depends on the text."""
         queries = [prompt]
         prompt_lower = prompt.lower()
         
         # Bollywood-specific queries
         if 'bollywood' in prompt_lower or 'hindi' in prompt_lower or 'indian' in prompt_lower:
-            queries.extend([
-                'bollywood hits',
-                'arijit singh',
-                'shreya ghoshal',
-                'atif aslam',
-                'hindi songs',
-                'bollywood romantic',
-                'ar rahman'
-            ])
-            return list(set(queries))[:7]
+            queries.extend(BOLLYWOOD_QUERIES[:BOLLYWOOD_CORE_QUERY_COUNT])
+            return tuple(set(queries))[:MAX_SEARCH_QUERIES]
         
         # Add genre-based queries
-        genres = ['pop', 'rock', 'hip hop', 'electronic', 'indie', 'jazz', 'country', 'r&b']
-        for genre in genres:
-            if genre in prompt_lower:
-                queries.append(f"{genre} music")
-                queries.append(f"best {genre}")
+        for genre in dict.fromkeys(_GENRE_RE.findall(prompt_lower)):
+            queries.append(f"{genre} music")
+            queries.append(f"best {genre}")
         
         # Add mood-based queries
-        if any(word in prompt_lower for word in ['happy', 'upbeat', 'energetic', 'party']):
-            queries.extend(['upbeat songs', 'dance music', 'party hits'])
-        elif any(word in prompt_lower for word in ['sad', 'emotional', 'melancholy']):
-            queries.extend(['sad songs', 'ballads', 'emotional music'])
-        elif any(word in prompt_lower for word in ['chill', 'relax', 'calm']):
-            queries.extend(['chill music', 'relaxing songs', 'ambient'])
-        elif any(word in prompt_lower for word in ['workout', 'gym', 'exercise']):
-            queries.extend(['workout music', 'high energy', 'pump up'])
+        moods = {int(match.lastgroup[4:]) for match in _MOOD_RE.finditer(prompt_lower)}
+        if moods:
+            queries.extend(MOOD_QUERIES[min(moods)][1])
         
         # Add popular fallbacks
-        queries.extend(['popular music', 'trending songs'])
+        queries.extend(POPULAR_QUERIES)
         
-        return list(set(queries))[:7]  # Remove duplicates and limit
+        return tuple(set(queries))[:MAX_SEARCH_QUERIES]  # Remove duplicates and limit
     
     async def _curate_playlist(
         self, 
@@ -310,29 +346,27 @@ class PlaylistGenerator:
             Example: 0,5,12,18,25,33,41,48
             """
             
-            response = self.model.generate_content(gemini_prompt)
+            response = await self.model.generate_content_async(gemini_prompt)
             
-            # Parse the response
-            selected_indices = []
+            # Parse, validate and select in a single pass over the response
+            selected_tracks = []
             try:
                 indices_text = response.text.strip()
                 # Remove any extra text and extract just the numbers
                 indices_text = indices_text.split('\n')[0]  # Take first line
-                selected_indices = [
-                    int(idx.strip()) 
-                    for idx in indices_text.split(',') 
-                    if idx.strip().isdigit() and int(idx.strip()) < len(tracks_to_process)
-                ]
+                seen_indices = set()
+                for token in indices_text.split(','):
+                    token = token.strip()
+                    if not token.isdigit():
+                        continue
+                    idx = int(token)
+                    if idx < len(tracks_to_process) and idx not in seen_indices:
+                        seen_indices.add(idx)
+                        selected_tracks.append(tracks_to_process[idx])
             except:
                 logger.warning("Failed to parse Gemini track selection")
                 return self._simple_track_selection(tracks, target_count, prompt)
             
-            # Validate indices and select tracks
-            selected_tracks = []
-            for idx in selected_indices:
-                if 0 <= idx < len(tracks_to_process):
-                    selected_tracks.append(tracks_to_process[idx])
-            
             # If we don't have enough tracks, fill with random selection
             if len(selected_tracks) < target_count // 2:
                 logger.warning("Gemini selection insufficient, using simple selection")
@@ -340,7 +374,9 @@ class PlaylistGenerator:
             
             # If we still need more tracks, add some popular ones
             if len(selected_tracks) < target_count:
-                remaining_tracks = [t for t in tracks if t not in selected_tracks]
+                # Identity set avoids comparing every candidate dict against the selection
+                selected_ids = {id(t) for t in selected_tracks}
+                remaining_tracks = [t for t in tracks if id(t) not in selected_ids]
                 remaining_tracks.sort(key=lambda x: x.get('popularity', 0), reverse=True)
                 needed = target_count - len(selected_tracks)
                 selected_tracks.extend(remaining_tracks[:needed])
@@ -406,6 +442,15 @@ class PlaylistGenerator:
         playlist_name: str
     ):
         """Save playlist data to JSON file."""
+        await asyncio.to_thread(self._save_playlist_data_sync, tracks, prompt, playlist_name)
+    
+    def _save_playlist_data_sync(
+        self, 
+        tracks: List[Dict[str, Any]], 
+        prompt: str, 
+        playlist_name: str
+    ):
+        """Write playlist data to a JSON file (blocking)."""
         try:
             playlist_data = {
                 "timestamp": datetime.now().isoformat(),
@@ -1,9 +1,14 @@
 import os
 import json
+import time
+import asyncio
 import logging
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
-from typing import Optional, List, Dict, Any
+from functools import partial
+from typing import Optional, List, Dict, Any, Tuple, Callable
+import httpx
 import tekore as tk
 
 
@@ -15,6 +20,74 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Spotify marks search responses cacheable for about two minutes
+SEARCH_CACHE_TTL = 120
+SEARCH_CACHE_MAX_SIZE = 1024
+
+TRACK_URI_PREFIX = 'spotify:track:'
+
+# Rate-limited requests are retried a couple of times at most, and never
+# when Spotify asks for a longer wait, so a 429 cannot stall a worker for long
+RATE_LIMIT_RETRIES = 2
+RATE_LIMIT_MAX_WAIT = 10
+
+# Paged user-data fetches keep a few page requests in flight at most, and stop
+# after MAX_PAGES pages per endpoint
+PAGE_FETCH_CONCURRENCY = 4
+MAX_PAGES = 20
+
+# After a failed token refresh, wait this long before trying again
+TOKEN_REFRESH_RETRY_DELAY = 30
+
+# One connection pool for all handlers, idle connections are kept long enough
+# to be reused between tool calls instead of re-handshaking TLS each time
+_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60.0)
+)
+
+class _BoundedRetryingSender(tk.RetryingSender):
+    """RetryingSender that gives up on 429s instead of retrying them indefinitely."""
+    
+    def send(self, request: tk.Request) -> tk.Response:
+        """Send the request, retrying server errors and short rate-limit waits."""
+        retries = max(self.retries, 0)
+        rate_limit_retries = RATE_LIMIT_RETRIES
+        delay_seconds = 1
+        
+        while True:
+            response = self.sender.send(request)
+            
+            if response.status_code == 429:
+                # SyncSender copies httpx's lower-cased header names
+                retry_after = response.headers.get("retry-after", 1)
+                try:
+                    wait_seconds = int(retry_after) + 1
+                except ValueError:
+                    wait_seconds = RATE_LIMIT_MAX_WAIT + 1
+                if rate_limit_retries <= 0 or wait_seconds > RATE_LIMIT_MAX_WAIT:
+                    logger.warning(f"Rate limited by Spotify, giving up (Retry-After: {retry_after})")
+                    break
+                rate_limit_retries -= 1
+                time.sleep(wait_seconds)
+            elif response.status_code >= 500 and retries > 0:
+                retries -= 1
+                time.sleep(delay_seconds)
+                delay_seconds *= 2
+            else:
+                break
+        return response
+
+def _track_to_dict(track) -> Dict[str, Any]:
+    """Convert a tekore track model to the track dict shape used across the app."""
+    return {
+        "name": track.name,
+        "artist": ", ".join(artist.name for artist in track.artists),
+        "album": track.album.name,
+        "id": track.id,
+        "uri": track.uri,
+        "popularity": track.popularity
+    }
+
 class SpotifyHandler:
     """Simplified Spotify handler using Tekore."""
     
@@ -34,11 +107,20 @@ class SpotifyHandler:
             port = int(os.getenv("PORT", 10000))
             self.redirect_uri = f"http://127.0.0.1:{port}/spotify/callback"
             logger.warning(f"No SPOTIFY_REDIRECT_URI set, using fallback: {self.redirect_uri}")
+        
+        # Opt-in: when set, the refresh token is kept here so restarts don't need the
+        # browser flow again. The restored session is served to every client.
+        self.token_file: Optional[str] = os.getenv("SPOTIFY_TOKEN_FILE") or None
 
+        # One sender (and its pooled HTTP connections) for auth, app and user requests.
+        # Retries back off on server errors and honour short Retry-After waits on 429s.
+        self.sender = _BoundedRetryingSender(retries=3, sender=tk.SyncSender(_http_client))
+        
         self.cred = tk.Credentials(
             client_id=self.client_id,
             client_secret=self.client_secret,
-            redirect_uri=self.redirect_uri
+            redirect_uri=self.redirect_uri,
+            sender=self.sender
         )
         
         self.scope = (
@@ -50,20 +132,101 @@ class SpotifyHandler:
         
         self.client: Optional[tk.Spotify] = None
         self.token: Optional[tk.Token] = None
-        self.app_client: Optional[tk.Spotify] = None
+        # Monotonic time after which the user token needs refreshing
+        self._token_refresh_at = 0.0
+        self._refresh_lock = threading.Lock()
+        # App client for search without authentication, created on first use
+        self._app_client: Optional[tk.Spotify] = None
+        self._user: Optional[tk.model.PrivateUser] = None
+        # (query, limit, searched as user) -> (fetched at, tracks), shared by search worker threads
+        self._search_cache: Dict[Tuple[str, int, bool], Tuple[float, List[Dict[str, Any]]]] = {}
+        self._search_cache_lock = threading.Lock()
         
-        # App token for search without authentication
-        self._initialize_app_client()
+        # Resume the previous user session if a refresh token was saved
+        self._restore_user_session()
+    
+    @property
+    def app_client(self) -> Optional[tk.Spotify]:
+        """App client for public operations, initialized on first access."""
+        if self._app_client is None:
+            self._initialize_app_client()
+        return self._app_client
     
     def _initialize_app_client(self):
         """Initialize app client for public operations."""
         try:
-            app_token = tk.request_client_token(self.client_id, self.client_secret)
-            self.app_client = tk.Spotify(app_token)
+            app_token = tk.RefreshingCredentials(
+                self.client_id, self.client_secret, sender=self.sender
+            ).request_client_token()
+            self._app_client = tk.Spotify(app_token, sender=self.sender)
             logger.info("App client initialized successfully")
         except Exception as e:
             logger.warning(f"Failed to get app token: {e}")
-            self.app_client = None
+            self._app_client = None
+    
+    def _restore_user_session(self):
+        """Authenticate from a saved refresh token, if persistence is enabled and one exists."""
+        if not self.token_file:
+            return
+        
+        try:
+            with open(self.token_file, 'r', encoding='utf-8') as f:
+                refresh_token = f.read().strip()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Failed to read saved token: {e}")
+            return
+        
+        if not refresh_token:
+            return
+        
+        try:
+            self.token = self.cred.refresh_user_token(refresh_token)
+            self.client = tk.Spotify(self.token, sender=self.sender)
+            self._schedule_refresh()
+            self._save_refresh_token()
+            # Test the connection, this also caches the user profile
+            user = self._current_user()
+            logger.info(f"Restored Spotify session for user: {user.display_name}")
+        except (tk.BadRequest, tk.Unauthorised) as e:
+            # The saved refresh token was revoked or is invalid, drop it
+            logger.warning(f"Saved Spotify session rejected, signing out: {e}")
+            self._clear_user_session()
+        except (tk.HTTPError, httpx.HTTPError) as e:
+            # Transient failure, start signed out but keep the saved token for the next start
+            logger.warning(f"Failed to restore Spotify session: {e}")
+            self.token = None
+            self.client = None
+            self._user = None
+    
+    def _clear_user_session(self):
+        """Sign the user out and forget the saved refresh token."""
+        self.token = None
+        self.client = None
+        self._user = None
+        if not self.token_file:
+            return
+        try:
+            os.remove(self.token_file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove saved token: {e}")
+    
+    def _save_refresh_token(self):
+        """Save the user refresh token, readable only by the current user."""
+        if not self.token_file or not self.token or not self.token.refresh_token:
+            return
+        
+        try:
+            fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode above only applies when the file is created, tighten existing files too
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self.token.refresh_token)
+        except OSError as e:
+            logger.warning(f"Failed to save refresh token: {e}")
     
     def get_auth_url(self) -> str:
         """Get Spotify authorization URL."""
@@ -76,34 +239,99 @@ class SpotifyHandler:
         try:
             logger.info(f"Attempting to authenticate with code: {code[:10]}...")
             self.token = self.cred.request_user_token(code)
+            self._user = None
             if self.token:
-                self.client = tk.Spotify(self.token)
-                # Test the connection
-                user = self.client.current_user()
+                self.client = tk.Spotify(self.token, sender=self.sender)
+                self._schedule_refresh()
+                # Test the connection, this also caches the user profile
+                user = self._current_user()
                 logger.info(f"Authenticated user: {user.display_name}")
+                self._save_refresh_token()
                 return True
             return False
-        except Exception as e:
+        except tk.HTTPError as e:
+            # Rejected codes and exhausted rate-limit retries; network errors propagate
             logger.error(f"Authentication failed: {e}")
             return False
     
+    def _current_user(self) -> tk.model.PrivateUser:
+        """Get the authenticated user's profile, fetched once per session."""
+        if self._user is None:
+            if not self.client:
+                raise RuntimeError("Client not available")
+            self._user = self.client.current_user()
+        return self._user
+    
+    def get_current_user_id(self) -> str:
+        """Get the authenticated user's Spotify ID."""
+        return self._current_user().id
+    
+    def _schedule_refresh(self) -> None:
+        """Record when the current user token should be refreshed (60s before expiry)."""
+        if self.token is not None:
+            self._token_refresh_at = time.monotonic() + self.token.expires_in - 60
+    
+    def _refresh_if_needed(self) -> None:
+        """Refresh the user token before it expires rather than after a 401."""
+        # Cheap check on every call, only lock and refresh once the deadline has passed
+        if self.token is None or self.client is None or time.monotonic() < self._token_refresh_at:
+            return
+        
+        with self._refresh_lock:
+            # Another thread may have refreshed while we waited for the lock
+            if time.monotonic() < self._token_refresh_at:
+                return
+            try:
+                logger.info("User token expiring, refreshing")
+                self.token = self.cred.refresh_user_token(self.token.refresh_token)
+                self.client.token = self.token
+                self._schedule_refresh()
+                self._save_refresh_token()
+            except (tk.BadRequest, tk.Unauthorised) as e:
+                # The refresh token was revoked or is invalid, the session cannot recover
+                logger.error(f"Token refresh rejected, signing out: {e}")
+                self._clear_user_session()
+            except (tk.HTTPError, httpx.HTTPError) as e:
+                # Transient failure, keep the current token and back off instead of
+                # re-requesting on every call
+                logger.error(f"Token refresh failed: {e}")
+                self._token_refresh_at = time.monotonic() + TOKEN_REFRESH_RETRY_DELAY
+    
     def is_authenticated(self) -> bool:
-        """Check if user is authenticated."""
+        """Check if user is authenticated, refreshing the token if it is about to expire."""
+        self._refresh_if_needed()
         return self.client is not None and self.token is not None
     
-    async def fetch_all_user_data(self) -> Dict[str, Any]:
-        """Fetch all user data and save to file."""
-        if not self.is_authenticated():
+    async def fetch_all_user_data(self, max_pages: int = MAX_PAGES) -> Dict[str, Any]:
+        """Fetch all user data (up to max_pages pages per list) and save to file."""
+        if not await asyncio.to_thread(self.is_authenticated):
             raise RuntimeError("Not authenticated")
         
         logger.info("Fetching user data...")
         
+        timestamp = datetime.now().isoformat()
+        
+        # Look the user up once, the profile and playlist requests both need it
+        try:
+            user = await asyncio.to_thread(self._current_user)
+        except Exception as e:
+            logger.error(f"Failed to get current user: {e}")
+            user = None
+        
+        # The requests are independent, overlap their network round-trips
+        top_tracks, recent_tracks, playlists = await asyncio.gather(
+            self._get_top_tracks(max_pages=max_pages),
+            asyncio.to_thread(self._get_recent_tracks),
+            self._get_playlists(user.id if user else None, max_pages=max_pages)
+        )
+        user_profile = self._get_user_profile(user)
+        
         user_data = {
-            "timestamp": datetime.now().isoformat(),
-            "user_profile": self._get_user_profile(),
-            "top_tracks": self._get_top_tracks(),
-            "recent_tracks": self._get_recent_tracks(),
-            "playlists": self._get_playlists()
+            "timestamp": timestamp,
+            "user_profile": user_profile,
+            "top_tracks": top_tracks,
+            "recent_tracks": recent_tracks,
+            "playlists": playlists
         }
         
         # Save to file
@@ -114,12 +342,11 @@ class SpotifyHandler:
         logger.info(f"User data saved to {filename}")
         return user_data
     
-    def _get_user_profile(self) -> Optional[Dict[str, Any]]:
-        """Get user profile."""
+    def _get_user_profile(self, user: Optional[tk.model.PrivateUser]) -> Optional[Dict[str, Any]]:
+        """Get user profile from the prefetched current user."""
         try:
-            if not self.client:
+            if not user:
                 return None
-            user = self.client.current_user()
             return {
                 "id": user.id,
                 "display_name": user.display_name,
@@ -131,23 +358,32 @@ class SpotifyHandler:
             logger.error(f"Failed to get user profile: {e}")
             return None
     
-    def _get_top_tracks(self, limit: int = 50) -> List[Dict[str, Any]]:
-        """Get user's top tracks."""
+    async def _fetch_all_pages(self, fetch: Callable[..., Any], limit: int, max_pages: int) -> List[Any]:
+        """Fetch up to max_pages pages of an offset-paged endpoint, a few at a time after the first."""
+        first_page = await asyncio.to_thread(fetch, limit=limit, offset=0)
+        semaphore = asyncio.Semaphore(PAGE_FETCH_CONCURRENCY)
+        
+        async def fetch_page(offset: int) -> Any:
+            async with semaphore:
+                return await asyncio.to_thread(fetch, limit=limit, offset=offset)
+        
+        last_offset = min(first_page.total, limit * max_pages)
+        pages = await asyncio.gather(*(
+            fetch_page(offset) for offset in range(limit, last_offset, limit)
+        ))
+        
+        items = list(first_page.items)
+        for page in pages:
+            items.extend(page.items)
+        return items
+    
+    async def _get_top_tracks(self, limit: int = 50, max_pages: int = MAX_PAGES) -> List[Dict[str, Any]]:
+        """Get the user's top tracks."""
         try:
             if not self.client:
                 return []
-            tracks = self.client.current_user_top_tracks(limit=limit)
-            return [
-                {
-                    "name": track.name,
-                    "artist": ", ".join([artist.name for artist in track.artists]),
-                    "album": track.album.name,
-                    "id": track.id,
-                    "uri": track.uri,
-                    "popularity": track.popularity
-                }
-                for track in tracks.items
-            ]
+            tracks = await self._fetch_all_pages(self.client.current_user_top_tracks, limit, max_pages)
+            return [_track_to_dict(track) for track in tracks]
         except Exception as e:
             logger.error(f"Failed to get top tracks: {e}")
             return []
@@ -161,7 +397,7 @@ class SpotifyHandler:
             return [
                 {
                     "name": item.track.name,
-                    "artist": ", ".join([artist.name for artist in item.track.artists]),
+                    "artist": ", ".join(artist.name for artist in item.track.artists),
                     "played_at": item.played_at.isoformat() if item.played_at else None,
                     "id": item.track.id,
                     "uri": item.track.uri,
@@ -173,23 +409,27 @@ class SpotifyHandler:
             logger.error(f"Failed to get recent tracks: {e}")
             return []
     
-    def _get_playlists(self, limit: int = 50) -> List[Dict[str, Any]]:
-        """Get user's playlists."""
+    async def _get_playlists(
+        self, user_id: Optional[str], limit: int = 50, max_pages: int = MAX_PAGES
+    ) -> List[Dict[str, Any]]:
+        """Get the user's playlists."""
         try:
-            if not self.client:
+            if not self.client or not user_id:
                 return []
             
-            user = self.client.current_user()
-            playlists = self.client.playlists(user.id, limit=limit)
+            playlists = await self._fetch_all_pages(partial(self.client.playlists, user_id), limit, max_pages)
             playlist_list = []
             
-            for playlist in playlists.items:
+            for playlist in playlists:
+                # Spotify can return null entries for unavailable playlists
+                if playlist is None:
+                    continue
                 playlist_data = {
-                    "name": getattr(playlist, 'name', 'Unknown'),
-                    "description": getattr(playlist, 'description', '') or "",
-                    "tracks_total": getattr(getattr(playlist, 'tracks', None), 'total', 0) if playlist else 0,
-                    "id": getattr(playlist, 'id', ''),
-                    "public": getattr(playlist, 'public', False)
+                    "name": playlist.name or 'Unknown',
+                    "description": playlist.description or "",
+                    "tracks_total": playlist.tracks.total if playlist.tracks else 0,
+                    "id": playlist.id,
+                    "public": playlist.public
                 }
                 playlist_list.append(playlist_data)
             
@@ -199,37 +439,51 @@ class SpotifyHandler:
             return []
     
     def search_tracks(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
-        """Search for tracks."""
+        """Search for tracks, reusing results of identical searches made in the last two minutes."""
         try:
             # Use authenticated client if available, otherwise use app client
-            client = self.client if self.is_authenticated() else self.app_client
+            as_user = self.is_authenticated()
+            client = self.client if as_user else self.app_client
             if not client:
                 logger.error("No Spotify client available for search")
                 return []
             
+            # User and app client searches can return different results, cache them apart
+            cache_key = (query.lower(), limit, as_user)
+            with self._search_cache_lock:
+                cached = self._search_cache.get(cache_key)
+            if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+                logger.info(f"Using cached search results for '{query}'")
+                return list(cached[1])
+            
             logger.info(f"Searching for tracks: '{query}' (limit: {limit})")
             results = client.search(query=query, types=('track',), limit=limit)
             
             if results and len(results) > 0:
                 tracks = results[0]  # First element is tracks paging
-                track_list = [
-                    {
-                        "name": track.name,
-                        "artist": ", ".join([artist.name for artist in track.artists]),
-                        "album": track.album.name,
-                        "id": track.id,
-                        "uri": track.uri,
-                        "popularity": track.popularity
-                    }
-                    for track in tracks.items
-                ]
+                track_list = [_track_to_dict(track) for track in tracks.items]
                 logger.info(f"Found {len(track_list)} tracks for query '{query}'")
-                return track_list
+                self._cache_search(cache_key, track_list)
+                return list(track_list)
             return []
         except Exception as e:
             logger.error(f"Search failed for '{query}': {e}")
             return []
     
+    def _cache_search(self, cache_key: Tuple[str, int, bool], track_list: List[Dict[str, Any]]):
+        """Store search results, evicting the oldest entry when the cache is full."""
+        with self._search_cache_lock:
+            self._search_cache.pop(cache_key, None)
+            if len(self._search_cache) >= SEARCH_CACHE_MAX_SIZE:
+                del self._search_cache[next(iter(self._search_cache))]
+            self._search_cache[cache_key] = (time.monotonic(), track_list)
+    
+    async def search_tracks_many(self, queries: List[str], limit: int = 20) -> List[List[Dict[str, Any]]]:
+        """Search for several queries concurrently, returning results in query order."""
+        return list(await asyncio.gather(*(
+            asyncio.to_thread(self.search_tracks, query, limit) for query in queries
+        )))
+    
     def get_recommendations(self, seed_track_ids: List[str], limit: int = 20) -> List[Dict[str, Any]]:
         """Get track recommendations."""
         if not self.is_authenticated():
@@ -248,72 +502,54 @@ class SpotifyHandler:
             
             logger.info(f"Getting recommendations with {len(valid_seeds)} seed tracks: {valid_seeds}")
             
-            # Validate track IDs by checking if they exist first
+            # Validate track IDs by checking if they exist first, in a single request
             validated_seeds = []
-            for track_id in valid_seeds:
-                try:
-                    track = self.client.track(track_id)
-                    if track:
-                        validated_seeds.append(track_id)
-                        logger.debug(f"Validated track ID: {track_id}")
-                except Exception as e:
-                    logger.warning(f"Invalid track ID {track_id}: {e}")
-                    continue
+            try:
+                tracks = self.client.tracks(valid_seeds)
+                validated_seeds = [track.id for track in tracks if track]
+                logger.debug(f"Validated track IDs: {validated_seeds}")
+            except Exception as e:
+                # A malformed ID fails the whole batch, fall back to checking one by one
+                logger.warning(f"Batch track validation failed: {e}")
+                for track_id in valid_seeds:
+                    try:
+                        track = self.client.track(track_id)
+                        if track:
+                            validated_seeds.append(track_id)
+                            logger.debug(f"Validated track ID: {track_id}")
+                    except Exception as e:
+                        logger.warning(f"Invalid track ID {track_id}: {e}")
+                        continue
             
             if not validated_seeds:
                 logger.warning("No valid track IDs after validation")
                 return []
             
-            # Make the recommendations request with validated IDs
-            try:
-                recommendations = self.client.recommendations(
-                    track_ids=validated_seeds,
-                    limit=limit
-                )
-                
-                rec_list = [
-                    {
-                        "name": track.name,
-                        "artist": ", ".join([artist.name for artist in track.artists]),
-                        "album": track.album.name,
-                        "id": track.id,
-                        "uri": track.uri,
-                        "popularity": track.popularity
-                    }
-                    for track in recommendations.tracks
-                ]
-                logger.info(f"Got {len(rec_list)} recommendations")
-                return rec_list
-                
-            except Exception as e:
-                logger.error(f"Recommendations API call failed: {e}")
-                # Try with fewer seeds if the request failed
-                if len(validated_seeds) > 1:
+            # Make the recommendations request with validated IDs, retrying with
+            # just 2 seeds if the full request fails
+            seed_attempts = [validated_seeds]
+            if len(validated_seeds) > 1:
+                seed_attempts.append(validated_seeds[:2])
+            
+            for attempt, seeds in enumerate(seed_attempts):
+                if attempt:
                     logger.info("Retrying with fewer seed tracks...")
-                    try:
-                        recommendations = self.client.recommendations(
-                            track_ids=validated_seeds[:2],  # Try with just 2 seeds
-                            limit=limit
-                        )
-                        
-                        rec_list = [
-                            {
-                                "name": track.name,
-                                "artist": ", ".join([artist.name for artist in track.artists]),
-                                "album": track.album.name,
-                                "id": track.id,
-                                "uri": track.uri,
-                                "popularity": track.popularity
-                            }
-                            for track in recommendations.tracks
-                        ]
-                        logger.info(f"Got {len(rec_list)} recommendations with fewer seeds")
-                        return rec_list
-                    except Exception as e2:
-                        logger.error(f"Retry also failed: {e2}")
-                        return []
-                else:
-                    return []
+                try:
+                    recommendations = self.client.recommendations(
+                        track_ids=seeds,
+                        limit=limit
+                    )
+                    
+                    rec_list = [_track_to_dict(track) for track in recommendations.tracks]
+                    logger.info(f"Got {len(rec_list)} recommendations{' with fewer seeds' if attempt else ''}")
+                    return rec_list
+                except Exception as e:
+                    if attempt:
+                        logger.error(f"Retry also failed: {e}")
+                    else:
+                        logger.error(f"Recommendations API call failed: {e}")
+            
+            return []
                     
         except Exception as e:
             logger.error(f"Recommendations failed: {e}")
@@ -328,7 +564,7 @@ class SpotifyHandler:
             if not self.client:
                 raise RuntimeError("Client not available")
                 
-            user = self.client.current_user()
+            user = self._current_user()
             logger.info(f"Creating playlist '{name}' for user {user.display_name}")
             
             playlist = self.client.playlist_create(
@@ -359,7 +595,12 @@ class SpotifyHandler:
                 playlist_id = playlist_id.split("playlist/")[-1]
             
             # Filter valid track URIs
-            valid_uris = [uri for uri in track_uris if uri and uri.startswith('spotify:track:')]
+            # Length guard also rejects a bare prefix with no track ID
+            prefix_len = len(TRACK_URI_PREFIX)
+            valid_uris = [
+                uri for uri in track_uris
+                if uri and len(uri) > prefix_len and uri.startswith(TRACK_URI_PREFIX)
+            ]
             
             if not valid_uris:
                 logger.warning("No valid track URIs to add")